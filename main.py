@@ -1,29 +1,119 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, NamedTuple, Optional, Union
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import os
+import sys
+import time
 import logging
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from threading import Lock
+from functools import lru_cache
+from math import fsum
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
 
-# Configuração de logging
+# Configuração de logging: em produção só avisos e erros; LOG_LEVEL=INFO (ou
+# DEBUG) liga o diagnóstico detalhado do histórico
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("api-controle-hidrico")
+_nivel_log = (os.environ.get("LOG_LEVEL") or "WARNING").upper()
+# getLevelName devolve o número do nível para nomes conhecidos; um valor inválido
+# não pode derrubar a importação (e com ela todas as rotas)
+if isinstance(logging.getLevelName(_nivel_log), int):
+    logger.setLevel(_nivel_log)
+else:
+    logger.setLevel(logging.WARNING)
+    logger.warning("LOG_LEVEL inválido: %r; usando WARNING.", _nivel_log)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cria o client do DynamoDB (e resolve as credenciais) na subida do servidor,
+    # fora do caminho da primeira requisição
+    _cliente_dynamodb()
+    yield
 
-# Inicialização do DynamoDB
-dynamodb = boto3.resource(
-    "dynamodb",
-    region_name=os.environ.get("AWS_REGION", "us-east-1")
-)
-table_registros = dynamodb.Table("controleHidrico")
+app = FastAPI(lifespan=lifespan)
+
+TABELA_REGISTROS = "controleHidrico"
+# Registros do usuário: PK = USER#<id>, SK = REG#<timestamp>
+CONDICAO_HISTORICO = "PK = :pk AND begins_with(SK, :reg)"
+PREFIXO_REGISTRO = "REG#"
+# Registros a partir de uma SK conhecida; "$" vem logo após "#", então "REG$"
+# é maior que qualquer SK "REG#..." e mantém a faixa dentro dos registros
+CONDICAO_HISTORICO_APOS = "PK = :pk AND SK BETWEEN :de AND :ate"
+FIM_PREFIXO_REGISTRO = "REG$"
+LIMITE_HISTORICO = 200
+MAX_USUARIOS_POR_LOTE = 100
+# Consultam o DynamoDB ao mesmo tempo as rotas síncronas, no threadpool do FastAPI
+# (40 threads por padrão), e os workers da rota de lote; o pool de conexões do
+# botocore (10 por padrão) cobre os dois para não descartar e reabrir conexões
+THREADS_REQUISICOES = 40
+MAX_CONSULTAS_PARALELAS = 32
+MAX_CONEXOES_DYNAMODB = THREADS_REQUISICOES + MAX_CONSULTAS_PARALELAS
+
+# Inicialização do DynamoDB adiada para o primeiro uso e reaproveitada pelo container.
+# O client de baixo nível evita a camada resource, que embrulha todo número em Decimal.
+# Usa uma Session própria: a sessão padrão do boto3 não é segura para criação
+# concorrente de clients pelas threads do FastAPI.
+@lru_cache(maxsize=1)
+def _cliente_dynamodb():
+    return boto3.session.Session().client(
+        "dynamodb",
+        region_name=os.environ.get("AWS_REGION", "us-east-1"),
+        config=Config(max_pool_connections=MAX_CONEXOES_DYNAMODB)
+    )
+
+# Campos do registro usados na previsão, por versão do esquema gravado:
+# (campo de data, campo de líquido). O padrão é o esquema atual (v2).
+ESQUEMAS_REGISTRO = {
+    "v1": ("horario", "quantidadeLiquidoM"),
+    "v2": ("timestamp", "quantidadeLiquidoMl"),
+}
+_versao_esquema = (os.environ.get("SCHEMA_VERSION") or "v2").lower()
+if _versao_esquema not in ESQUEMAS_REGISTRO:
+    # Como no LOG_LEVEL, um valor inválido não pode derrubar a importação
+    logger.warning("SCHEMA_VERSION inválido: %r; usando v2 (aceitos: %s).", _versao_esquema, ", ".join(ESQUEMAS_REGISTRO))
+    _versao_esquema = "v2"
+CAMPO_DATA, CAMPO_LIQUIDO = ESQUEMAS_REGISTRO[_versao_esquema]
+
+# Atributos pedidos ao DynamoDB (todos apelidados: "timestamp" é palavra reservada)
+ATRIBUTOS_HISTORICO = ("SK", CAMPO_DATA, CAMPO_LIQUIDO, "urineType", "quantidadeUrinaMl")
+NOMES_PROJECAO = {f"#a{i}": nome for i, nome in enumerate(ATRIBUTOS_HISTORICO)}
+PROJECAO_HISTORICO = ", ".join(NOMES_PROJECAO)
+
+# Modelos de resposta: com o tipo de retorno declarado o FastAPI serializa direto
+# para JSON via Pydantic, sem passar pelo jsonable_encoder + json.dumps
+class Healthcheck(BaseModel):
+    status: str
+    timestamp: datetime
+    env: dict
+
+class DebugPrevisao(BaseModel):
+    cateterismos: int
+    urine_types: List[str]
+
+class Previsao(BaseModel):
+    tempo_restante_aprox: Optional[str] = None
+    proximo_horario_previsto: Optional[str] = None
+    liquido_restante_ml: float
+    media_historica_ml: Optional[float] = None
+    previsao: Optional[str] = None
+    debug: Optional[DebugPrevisao] = None
+
+class ErroPrevisao(BaseModel):
+    status: int
+    erro: str
 
 @app.get("/healthcheck")
-def healthcheck():
+def healthcheck() -> Healthcheck:
     return {
         "status": "ok", 
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.utcnow(),
         "env": {
             "region": os.environ.get("AWS_REGION"),
             "has_key": bool(os.environ.get("AWS_ACCESS_KEY_ID"))
@@ -34,98 +124,213 @@ def healthcheck():
 def raiz():
     return {"mensagem": "API Controle Hidrico Online - Debug de urineType"}
 
-def buscar_historico(user_id: str, limit: int = 200):
-    logger.info(f"Buscando histórico para o usuário: {user_id}")
+def _valores_historico(user_id: str):
+    return {
+        ":pk": {"S": f"USER#{user_id}"},
+        ":reg": {"S": PREFIXO_REGISTRO},
+    }
+
+def _consultar_registros(user_id: str, limit: int, apos_chave: Optional[str] = None):
+    """Últimos `limit` registros do usuário em ordem cronológica; com `apos_chave`,
+    só os gravados depois dessa SK. Erros do DynamoDB são propagados."""
+    if apos_chave is None:
+        condicao, valores = CONDICAO_HISTORICO, _valores_historico(user_id)
+    else:
+        condicao = CONDICAO_HISTORICO_APOS
+        valores = {
+            ":pk": {"S": f"USER#{user_id}"},
+            ":de": {"S": apos_chave},
+            ":ate": {"S": FIM_PREFIXO_REGISTRO},
+        }
+    parametros = dict(
+        TableName=TABELA_REGISTROS,
+        KeyConditionExpression=condicao,
+        ExpressionAttributeValues=valores,
+        ProjectionExpression=PROJECAO_HISTORICO,
+        ExpressionAttributeNames=NOMES_PROJECAO,
+        ScanIndexForward=False
+    )
+    # Uma página do Query para em 1 MB; segue o LastEvaluatedKey só até
+    # completar `limit` registros
+    brutos = []
+    while True:
+        response = _cliente_dynamodb().query(Limit=limit - len(brutos), **parametros)
+        brutos.extend(response.get("Items", []))
+        continuacao = response.get("LastEvaluatedKey")
+        if continuacao is None or len(brutos) >= limit:
+            break
+        parametros["ExclusiveStartKey"] = continuacao
+
+    # Os atributos projetados são escalares: números ({"N": "250"}) viram
+    # float direto, sem Decimal; textos ({"S": ...}) passam como estão.
+    # A consulta vem do mais recente para o mais antigo (SK = REG#<timestamp>);
+    # a lista é devolvida em ordem cronológica.
+    items = []
+    for bruto in reversed(brutos):
+        item = {
+            campo: float(valor["N"]) if "N" in valor else valor.get("S")
+            for campo, valor in bruto.items()
+        }
+        # O BETWEEN inclui a própria SK de partida
+        if apos_chave is not None and item["SK"] == apos_chave:
+            continue
+        # Volume normalizado uma única vez: sempre float, ausente/nulo vale 0
+        item[CAMPO_LIQUIDO] = float(item.get(CAMPO_LIQUIDO) or 0)
+        items.append(item)
+    return items
+
+def buscar_historico(user_id: str, limit: int = LIMITE_HISTORICO):
+    logger.info("Buscando histórico para o usuário: %s", user_id)
     try:
-        response = table_registros.query(
-            KeyConditionExpression="PK = :pk",
-            ExpressionAttributeValues={":pk": f"USER#{user_id}"},
-            Limit=limit,
-            ScanIndexForward=False
-        )
-        items = response.get("Items", [])
-        logger.info(f"Registros brutos encontrados: {len(items)}")
-        
-        # Converter Decimal para float
-        for item in items:
-            for key, value in item.items():
-                if hasattr(value, 'to_eng_string'):
-                    item[key] = float(value)
+        items = _consultar_registros(user_id, limit)
+        logger.info("Registros brutos encontrados: %d", len(items))
         return items
     except Exception as e:
-        logger.error(f"Erro ao acessar DynamoDB: {str(e)}")
+        logger.error("Erro ao acessar DynamoDB: %s", e)
         return []
 
+# Cache em memória por usuário: a janela dos últimos LIMITE_HISTORICO registros
+# e a previsão calculada sobre ela (a previsão depende apenas do histórico).
+# Dentro do TTL a entrada é devolvida sem consultar o DynamoDB (painéis fazem
+# polling em segundos); depois disso só os registros novos são buscados e
+# incorporados à janela. Como a busca incremental não enxerga registros
+# editados, apagados ou gravados com SK antiga, a janela é relida por inteiro
+# quando a entrada passa de IDADE_MAXIMA_CACHE. Cada entrada guarda até 200
+# registros, daí o limite de usuários menor.
+MAX_USUARIOS_EM_CACHE = 1000
+TTL_CACHE_PREVISOES = 30
+IDADE_MAXIMA_CACHE = 300
+_cache_previsoes = OrderedDict()
+_lock_cache_previsoes = Lock()
+
+class _EntradaCache(NamedTuple):
+    registros: List[dict]
+    previsao: Optional[dict]
+    verificada_em: float
+    criada_em: float
+
+def _entrada_em_cache(user_id: str) -> Optional[_EntradaCache]:
+    with _lock_cache_previsoes:
+        entrada = _cache_previsoes.get(user_id)
+        if entrada is not None:
+            _cache_previsoes.move_to_end(user_id)
+        return entrada
+
+def _guardar_previsao(user_id: str, registros: List[dict], previsao, criada_em: Optional[float] = None):
+    """Guarda a janela e a previsão; `criada_em` é mantido nas atualizações
+    incrementais e só recomeça numa leitura completa do histórico."""
+    agora = time.monotonic()
+    with _lock_cache_previsoes:
+        _cache_previsoes[user_id] = _EntradaCache(registros, previsao, agora, agora if criada_em is None else criada_em)
+        _cache_previsoes.move_to_end(user_id)
+        if len(_cache_previsoes) > MAX_USUARIOS_EM_CACHE:
+            _cache_previsoes.popitem(last=False)
+
+def _invalidar_previsao(user_id: str) -> bool:
+    with _lock_cache_previsoes:
+        return _cache_previsoes.pop(user_id, None) is not None
+
+UTC = timezone.utc
+SUFIXO_UTC = "+00:00"
+
+# A partir do Python 3.11 o fromisoformat (em C) já aceita o sufixo "Z"
+if sys.version_info >= (3, 11):
+    _from_iso = datetime.fromisoformat
+else:
+    def _from_iso(valor):
+        return datetime.fromisoformat(valor[:-1] + SUFIXO_UTC if valor.endswith('Z') else valor)
+
+def parse_date(valor):
+    # Epoch acima de 1e11 só pode estar em milissegundos (1e11 s ≈ ano 5138)
+    if isinstance(valor, (int, float)):
+        return datetime.fromtimestamp(valor / 1000 if valor > 1e11 else valor, tz=UTC)
+    return _from_iso(valor)
+
+# urineType que marca um cateterismo; 1.0 (número vindo do DynamoDB) tem o
+# mesmo hash de 1, então um único teste de pertinência cobre todos os casos
+TIPOS_CATETERISMO = frozenset((1, "1"))
+
+def _registrar_dados_insuficientes(regs: List[dict], n_cateterismos: int):
+    """DEBUG do caso sem cateterismos suficientes: quais urineType o histórico tem."""
+    if logger.isEnabledFor(logging.INFO):
+        urine_types = {f"{r['urineType']} ({type(r['urineType']).__name__})" for r in regs if r.get('urineType') is not None}
+        logger.info("Valores de 'urineType' encontrados no histórico: %s", list(urine_types))
+        if not n_cateterismos:
+            # Se não achou 1, vamos ver o que tem em um registro que parece ser de urina
+            for r in regs:
+                if 'quantidadeUrinaMl' in r:
+                    logger.info("Exemplo de registro de urina: %s", r)
+                    break
+    logger.warning("Dados insuficientes: %d cateterismos encontrados.", n_cateterismos)
+
 def calcular_previsao(registros: List[dict]):
+    """Previsão do próximo cateterismo a partir dos registros de buscar_historico
+    (com o volume de líquido já normalizado para float)."""
     if not registros:
         return None
     
-    campo_data = 'timestamp'
-    campo_liquido = 'quantidadeLiquidoMl'
+    campo_data = CAMPO_DATA
+    campo_liquido = CAMPO_LIQUIDO
     
-    # FILTRAGEM: Manter apenas registros que possuem o campo de data
-    regs_validos = [r for r in registros if campo_data in r and r[campo_data]]
+    # FILTRAGEM: Manter apenas registros que possuem o campo de data, contando os
+    # cateterismos na mesma passada para sair antes de ordenar quando faltam dados
+    regs_validos = []
+    n_cateterismos = 0
+    for r in registros:
+        if r.get(campo_data):
+            regs_validos.append(r)
+            if r.get('urineType') in TIPOS_CATETERISMO:
+                n_cateterismos += 1
     
     if not regs_validos:
         return None
+    if n_cateterismos < 2:
+        _registrar_dados_insuficientes(regs_validos, n_cateterismos)
+        return None
 
-    # Ordenação cronológica
-    regs = sorted(regs_validos, key=lambda x: x[campo_data])
+    # Ordenação cronológica direto pelo valor bruto (ISO-8601 ordena como texto).
+    # buscar_historico já entrega em ordem de SK, então o Timsort encontra uma
+    # única sequência crescente e termina em O(N); a ordenação fica como garantia
+    # caso o campo de data e a SK divirjam.
+    regs = sorted(regs_validos, key=itemgetter(campo_data))
 
-    # DEBUG: Inspecionar os valores de urineType nos registros
+    # Passada única: localiza os cateterismos (TIPOS_CATETERISMO), fecha o volume
+    # de cada intervalo ao encontrar o próximo e inspeciona os valores de urineType
+    # para o DEBUG
     urine_types_encontrados = set()
-    exemplo_urina = None
-    for r in regs:
+    cateterismos = []
+    intervalos_vol = []
+    vol_acumulado = 0.0
+    for i, r in enumerate(regs):
         u_type = r.get('urineType')
         if u_type is not None:
             urine_types_encontrados.add(f"{u_type} ({type(u_type).__name__})")
-            if u_type == 1 or str(u_type) == "1":
-                exemplo_urina = r
-    
-    logger.info(f"Valores de 'urineType' encontrados no histórico: {list(urine_types_encontrados)}")
-    if not exemplo_urina:
-        # Se não achou 1, vamos ver o que tem em um registro que parece ser de urina
-        for r in regs:
-            if 'quantidadeUrinaMl' in r:
-                logger.info(f"Exemplo de registro de urina: {r}")
-                break
-
-    # Identificar cateterismos (urineType = 1 ou "1")
-    cateterismos = [i for i, r in enumerate(regs) if str(r.get('urineType')) == "1"]
-    logger.info(f"Índices de cateterismo encontrados: {cateterismos}")
-    
-    if len(cateterismos) < 2:
-        logger.warning(f"Dados insuficientes: {len(cateterismos)} cateterismos encontrados.")
-        return None
+            if u_type in TIPOS_CATETERISMO:
+                if cateterismos:
+                    intervalos_vol.append(vol_acumulado)
+                vol_acumulado = 0.0
+                cateterismos.append(i)
+        vol_acumulado += r[campo_liquido]
 
-    # Calcular volumes entre cateterismos
-    intervalos_vol = []
-    for i in range(len(cateterismos) - 1):
-        idx_start, idx_end = cateterismos[i], cateterismos[i+1]
-        vol = sum(float(regs[j].get(campo_liquido, 0) or 0) for j in range(idx_start, idx_end))
-        intervalos_vol.append(vol)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Valores de 'urineType' encontrados no histórico: %s", list(urine_types_encontrados))
+        logger.info("Índices de cateterismo encontrados: %s", cateterismos)
 
-    media_vol = sum(intervalos_vol) / len(intervalos_vol)
+    media_vol = fsum(intervalos_vol) / len(intervalos_vol)
     idx_last_cat = cateterismos[-1]
-    vol_desde_ultimo = sum(float(regs[j].get(campo_liquido, 0) or 0) for j in range(idx_last_cat, len(regs)))
+    # Após o último cateterismo o acumulador não é mais zerado
+    vol_desde_ultimo = vol_acumulado
     restante = media_vol - vol_desde_ultimo
     
-    try:
-        def parse_date(date_str):
-            try:
-                if isinstance(date_str, (int, float)):
-                    return datetime.fromtimestamp(date_str)
-                return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-            except:
-                if isinstance(date_str, (int, float)) and date_str > 1e11:
-                    return datetime.fromtimestamp(date_str / 1000)
-                raise
+    num_intervalos = len(cateterismos) - 1
 
+    # Só a conversão das datas e a aritmética de datetime podem falhar aqui
+    # (formato inválido, mistura de datas com/sem fuso, horizonte fora do limite)
+    try:
         t_last_cat = parse_date(regs[idx_last_cat][campo_data])
         t_first_cat = parse_date(regs[cateterismos[0]][campo_data])
         
         total_sec = (t_last_cat - t_first_cat).total_seconds()
-        num_intervalos = len(cateterismos) - 1
         
         if total_sec <= 0:
             return {"previsao": "Erro de cronologia", "liquido_restante_ml": restante}
@@ -136,27 +341,83 @@ def calcular_previsao(registros: List[dict]):
         
         sec_restante = restante / taxa_ml_sec
         previsao_hora = t_last_cat + timedelta(seconds=sec_restante)
-        
-        return {
-            "tempo_restante_aprox": str(timedelta(seconds=int(max(0, sec_restante)))),
-            "proximo_horario_previsto": previsao_hora.isoformat(),
-            "liquido_restante_ml": round(restante, 2),
-            "media_historica_ml": round(media_vol, 2),
-            "debug": {
-                "cateterismos": len(cateterismos),
-                "urine_types": list(urine_types_encontrados)
-            }
-        }
-    except Exception as e:
-        logger.error(f"Erro cálculo: {str(e)}")
+    except (TypeError, ValueError, OverflowError, OSError) as e:
+        logger.error("Erro cálculo: %s", e)
         return None
+    
+    return {
+        "tempo_restante_aprox": str(timedelta(seconds=int(max(0, sec_restante)))),
+        "proximo_horario_previsto": previsao_hora.isoformat(),
+        "liquido_restante_ml": round(restante, 2),
+        "media_historica_ml": round(media_vol, 2),
+        "debug": {
+            "cateterismos": len(cateterismos),
+            "urine_types": list(urine_types_encontrados)
+        }
+    }
 
-@app.get("/prever-cateterismo/{user_id}")
-def prever(user_id: str):
-    regs = buscar_historico(user_id)
-    if not regs:
-        raise HTTPException(status_code=404, detail="Usuário sem registros.")
+def _atualizar_previsao(user_id: str, entrada: _EntradaCache):
+    """Incorpora à janela em cache os registros gravados desde a última SK conhecida."""
+    try:
+        novos = _consultar_registros(user_id, LIMITE_HISTORICO, apos_chave=entrada.registros[-1]["SK"])
+    except (ClientError, BotoCoreError) as e:
+        # Sem acesso ao DynamoDB, a última previsão conhecida ainda é a melhor resposta
+        logger.error("Erro ao acessar DynamoDB: %s", e)
+        return entrada.previsao
+    if not novos:
+        _guardar_previsao(user_id, entrada.registros, entrada.previsao, entrada.criada_em)
+        return entrada.previsao
+    regs = (entrada.registros + novos)[-LIMITE_HISTORICO:]
     res = calcular_previsao(regs)
+    _guardar_previsao(user_id, regs, res, entrada.criada_em)
+    return res
+
+def prever_usuario(user_id: str):
+    entrada = _entrada_em_cache(user_id)
+    agora = time.monotonic()
+    if entrada is not None and agora - entrada.criada_em >= IDADE_MAXIMA_CACHE:
+        entrada = None
+    if entrada is not None and agora - entrada.verificada_em < TTL_CACHE_PREVISOES:
+        res = entrada.previsao
+    elif entrada is not None:
+        res = _atualizar_previsao(user_id, entrada)
+    else:
+        regs = buscar_historico(user_id)
+        if not regs:
+            raise HTTPException(status_code=404, detail="Usuário sem registros.")
+        res = calcular_previsao(regs)
+        _guardar_previsao(user_id, regs, res)
     if not res:
         raise HTTPException(status_code=400, detail="Dados insuficientes (cateterismos não encontrados). Verifique os logs para ver os valores de urineType.")
     return res
+
+@app.get("/prever-cateterismo/{user_id}", response_model_exclude_unset=True)
+def prever(user_id: str) -> Previsao:
+    return prever_usuario(user_id)
+
+# Previsão para vários usuários numa chamada só (painéis de acompanhamento):
+# as consultas rodam em paralelo no executor do lote (MAX_CONSULTAS_PARALELAS)
+_executor_lote = ThreadPoolExecutor(max_workers=MAX_CONSULTAS_PARALELAS)
+
+def _prever_no_lote(user_id: str):
+    try:
+        return prever_usuario(user_id)
+    except HTTPException as e:
+        return {"status": e.status_code, "erro": e.detail}
+    except Exception as e:
+        # Falha inesperada de um usuário não derruba o lote inteiro
+        logger.exception("Erro ao prever para o usuário %s no lote", user_id)
+        return {"status": 500, "erro": f"Erro interno: {e}"}
+
+@app.post("/prever-cateterismo/lote", response_model_exclude_unset=True)
+def prever_lote(user_ids: List[str]) -> Dict[str, Union[Previsao, ErroPrevisao]]:
+    # IDs repetidos são consultados uma vez só (dict preserva a ordem)
+    unicos = list(dict.fromkeys(user_ids))
+    if len(unicos) > MAX_USUARIOS_POR_LOTE:
+        raise HTTPException(status_code=400, detail=f"Máximo de {MAX_USUARIOS_POR_LOTE} usuários por lote.")
+    return dict(zip(unicos, _executor_lote.map(_prever_no_lote, unicos)))
+
+@app.post("/invalidar-cache/{user_id}")
+def invalidar_cache(user_id: str):
+    # Chamado pelo serviço de ingestão ao gravar um novo registro
+    return {"invalidado": _invalidar_previsao(user_id)}
@@ -2,6 +2,12 @@ import requests
 import time
 import subprocess
 import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
 
 def test_api():
     # Iniciar o servidor em segundo plano
@@ -38,5 +44,198 @@ def test_api():
         # print("\nServer STDOUT:", stdout.decode())
         # print("Server STDERR:", stderr.decode())
 
+
+class DynamoFalso:
+    """Tabela controleHidrico em memória que atende às consultas de _consultar_registros."""
+
+    def __init__(self, tamanho_pagina=1000):
+        self.itens = {}
+        self.consultas = []
+        self.tamanho_pagina = tamanho_pagina
+        self.proximo_ts = 1_700_000_000
+
+    def adicionar(self, user_id, liquido=None, cateterismo=False, ts=None):
+        if ts is None:
+            self.proximo_ts += 3600
+            ts = self.proximo_ts
+        item = {"PK": {"S": f"USER#{user_id}"}, "SK": {"S": f"REG#{ts}"}, "timestamp": {"N": str(ts)}}
+        if liquido is not None:
+            item["quantidadeLiquidoMl"] = {"N": str(liquido)}
+        if cateterismo:
+            item["urineType"] = {"N": "1"}
+        self.itens.setdefault(f"USER#{user_id}", []).append(item)
+        return item
+
+    def query(self, **kw):
+        self.consultas.append(kw)
+        valores = kw["ExpressionAttributeValues"]
+        itens = sorted(self.itens.get(valores[":pk"]["S"], []), key=lambda i: i["SK"]["S"], reverse=not kw["ScanIndexForward"])
+        if ":reg" in valores:
+            itens = [i for i in itens if i["SK"]["S"].startswith(valores[":reg"]["S"])]
+        else:
+            itens = [i for i in itens if valores[":de"]["S"] <= i["SK"]["S"] <= valores[":ate"]["S"]]
+        inicio = 0
+        if "ExclusiveStartKey" in kw:
+            inicio = [i["SK"]["S"] for i in itens].index(kw["ExclusiveStartKey"]["SK"]["S"]) + 1
+        pagina = itens[inicio:inicio + min(kw["Limit"], self.tamanho_pagina)]
+        nomes = set(kw["ExpressionAttributeNames"].values())
+        resposta = {"Items": [{k: v for k, v in i.items() if k in nomes} for i in pagina]}
+        if pagina and inicio + len(pagina) < len(itens):
+            resposta["LastEvaluatedKey"] = {"PK": pagina[-1]["PK"], "SK": pagina[-1]["SK"]}
+        return resposta
+
+
+@pytest.fixture
+def dynamo(monkeypatch):
+    falso = DynamoFalso()
+    monkeypatch.setattr(main, "_cliente_dynamodb", lambda: falso)
+    main._cache_previsoes.clear()
+    yield falso
+    main._cache_previsoes.clear()
+
+
+@pytest.fixture
+def cliente():
+    return TestClient(main.app)
+
+
+def popular(dynamo, user_id="u", n=30):
+    for i in range(n):
+        dynamo.adicionar(user_id, liquido=100 + i, cateterismo=i % 6 == 0)
+
+
+def previsao_completa(user_id="u"):
+    return main.calcular_previsao(main._consultar_registros(user_id, main.LIMITE_HISTORICO))
+
+
+def test_cache_dentro_do_ttl_nao_consulta_dynamodb(dynamo, cliente):
+    popular(dynamo)
+    primeira = cliente.get("/prever-cateterismo/u")
+    assert primeira.status_code == 200
+    dynamo.consultas.clear()
+    segunda = cliente.get("/prever-cateterismo/u")
+    assert segunda.json() == primeira.json()
+    assert dynamo.consultas == []
+
+
+def test_atualizacao_incremental_igual_ao_recalculo_completo(dynamo, cliente, monkeypatch):
+    popular(dynamo)
+    cliente.get("/prever-cateterismo/u")
+    monkeypatch.setattr(main, "TTL_CACHE_PREVISOES", 0)
+    # O último registro em cache é um cateterismo: ele volta no BETWEEN e não
+    # pode ser contado duas vezes
+    dynamo.adicionar("u", liquido=50, cateterismo=True)
+    cliente.get("/prever-cateterismo/u")
+    for i in range(4):
+        dynamo.adicionar("u", liquido=70, cateterismo=i == 3)
+    dynamo.consultas.clear()
+    resposta = cliente.get("/prever-cateterismo/u")
+    assert [c["KeyConditionExpression"] for c in dynamo.consultas] == [main.CONDICAO_HISTORICO_APOS]
+    esperado = previsao_completa()
+    assert resposta.json()["media_historica_ml"] == esperado["media_historica_ml"]
+    assert resposta.json()["proximo_horario_previsto"] == esperado["proximo_horario_previsto"]
+    assert resposta.json()["debug"]["cateterismos"] == esperado["debug"]["cateterismos"]
+    chaves = [r["SK"] for r in main._cache_previsoes["u"].registros]
+    assert len(chaves) == len(set(chaves)) == 35
+
+
+def test_atualizacao_incremental_apara_janela_em_200(dynamo, cliente, monkeypatch):
+    dynamo.tamanho_pagina = 37
+    popular(dynamo, n=150)
+    cliente.get("/prever-cateterismo/u")
+    monkeypatch.setattr(main, "TTL_CACHE_PREVISOES", 0)
+    popular(dynamo, n=120)
+    resposta = cliente.get("/prever-cateterismo/u")
+    registros = main._cache_previsoes["u"].registros
+    assert len(registros) == main.LIMITE_HISTORICO
+    assert registros[-1]["SK"] == max(i["SK"]["S"] for i in dynamo.itens["USER#u"])
+    assert resposta.json()["media_historica_ml"] == previsao_completa()["media_historica_ml"]
+
+
+def test_consultar_registros_ignora_sk_de_partida(dynamo):
+    partida = dynamo.adicionar("u", liquido=100, cateterismo=True)["SK"]["S"]
+    dynamo.adicionar("u", liquido=200)
+    novos = main._consultar_registros("u", main.LIMITE_HISTORICO, apos_chave=partida)
+    assert [r["SK"] for r in novos] == [f"REG#{dynamo.proximo_ts}"]
+
+
+def test_entrada_antiga_rele_historico_completo(dynamo, cliente, monkeypatch):
+    popular(dynamo)
+    antes = cliente.get("/prever-cateterismo/u").json()
+    # Registro editado: a busca incremental não enxerga a mudança
+    for item in dynamo.itens["USER#u"]:
+        item["quantidadeLiquidoMl"] = {"N": "999"}
+    monkeypatch.setattr(main, "TTL_CACHE_PREVISOES", 0)
+    assert cliente.get("/prever-cateterismo/u").json() == antes
+    monkeypatch.setattr(main, "IDADE_MAXIMA_CACHE", 0)
+    depois = cliente.get("/prever-cateterismo/u").json()
+    assert depois["media_historica_ml"] == previsao_completa()["media_historica_ml"] != antes["media_historica_ml"]
+
+
+def test_invalidar_cache(dynamo, cliente):
+    popular(dynamo)
+    cliente.get("/prever-cateterismo/u")
+    assert cliente.post("/invalidar-cache/u").json() == {"invalidado": True}
+    assert cliente.post("/invalidar-cache/u").json() == {"invalidado": False}
+    dynamo.consultas.clear()
+    assert cliente.get("/prever-cateterismo/u").status_code == 200
+    assert dynamo.consultas[0]["KeyConditionExpression"] == main.CONDICAO_HISTORICO
+
+
+
+def test_lote_mapeia_erros_por_usuario_e_remove_repetidos(dynamo, cliente):
+    popular(dynamo, "a")
+    dynamo.adicionar("pouco", liquido=100, cateterismo=True)
+    resposta = cliente.post("/prever-cateterismo/lote", json=["pouco", "a", "vazio", "a", "pouco"])
+    assert resposta.status_code == 200
+    corpo = resposta.json()
+    assert list(corpo) == ["pouco", "a", "vazio"]
+    assert corpo["a"]["media_historica_ml"] == previsao_completa("a")["media_historica_ml"]
+    assert corpo["pouco"]["status"] == 400
+    assert corpo["vazio"] == {"status": 404, "erro": "Usuário sem registros."}
+
+
+def test_lote_erro_inesperado_fica_restrito_ao_usuario(dynamo, cliente):
+    popular(dynamo, "a")
+    # Datas misturadas (texto e número) fazem o sorted() levantar TypeError
+    dynamo.adicionar("misto", liquido=100, cateterismo=True)
+    dynamo.adicionar("misto", liquido=100, cateterismo=True)
+    dynamo.itens["USER#misto"][0]["timestamp"] = {"S": "2024-01-01T10:00:00Z"}
+    corpo = cliente.post("/prever-cateterismo/lote", json=["a", "misto"]).json()
+    assert "media_historica_ml" in corpo["a"]
+    assert corpo["misto"]["status"] == 500
+
+
+def test_lote_acima_do_limite(dynamo, cliente):
+    ids = [str(i) for i in range(main.MAX_USUARIOS_POR_LOTE + 1)]
+    resposta = cliente.post("/prever-cateterismo/lote", json=ids)
+    assert resposta.status_code == 400
+    assert dynamo.consultas == []
+    # Repetidos não contam para o limite
+    assert cliente.post("/prever-cateterismo/lote", json=["x"] * 500).status_code == 200
+
+
+def test_lote_exige_lista(dynamo, cliente):
+    assert cliente.post("/prever-cateterismo/lote", json={"user_ids": ["a"]}).status_code == 422
+    assert cliente.post("/prever-cateterismo/lote", json="a").status_code == 422
+
+
+
+@pytest.mark.parametrize("valor, esperado", [
+    ("V1", "('horario', 'quantidadeLiquidoM')"),
+    ("v3", "('timestamp', 'quantidadeLiquidoMl')"),
+    ("", "('timestamp', 'quantidadeLiquidoMl')"),
+])
+def test_schema_version_invalido_nao_quebra_importacao(valor, esperado):
+    resultado = subprocess.run(
+        [sys.executable, "-c", "import main; print((main.CAMPO_DATA, main.CAMPO_LIQUIDO))"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, "SCHEMA_VERSION": valor},
+        capture_output=True, text=True
+    )
+    assert resultado.returncode == 0, resultado.stderr
+    assert resultado.stdout.strip() == esperado
+
+
 if __name__ == "__main__":
     test_api()